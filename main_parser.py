@@ -1,8 +1,13 @@
-import csv
+import io
+import mmap
 import os
+import time
 import uuid
-from collections import defaultdict
-from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import lru_cache
 from itertools import batched
 from zoneinfo import ZoneInfo
 from decimal import Decimal
@@ -33,11 +38,70 @@ AUS_TZ = ZoneInfo('Australia/Brisbane')  # seems this tz is recommended for AEST
 DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///:memory:')
 INSERT_BATCH_SIZE = 100
 CONSUMPTION_MAPPING_SIZE_LIMIT = 10 ** 5
+READ_BUFFER_SIZE = 1 << 20
+# rough size of the slices of the file handed to each worker when parsing in parallel
+PARALLEL_CHUNK_SIZE = 1 << 24
+# consumption is aggregated as a count of 10 ** -CONSUMPTION_SCALE units, an int unless a reading has more decimals
+CONSUMPTION_SCALE = 3
 
+# MySQL statements to bulk load a tab separated file of meter readings through a staging table,
+# summing any rows for the same (nmi, timestamp) key before merging them into meter_readings
+BULK_LOAD_STMTS = (
+    'CREATE TEMPORARY TABLE staging_meter_readings '
+    '(id CHAR(32) NOT NULL, nmi VARCHAR(10) NOT NULL, timestamp DATETIME NOT NULL, consumption NUMERIC(6, 3) NOT NULL)',
+    'LOAD DATA LOCAL INFILE {} INTO TABLE staging_meter_readings '
+    "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' (id, nmi, timestamp, consumption)",
+    'INSERT INTO meter_readings (id, nmi, timestamp, consumption) '
+    'SELECT MIN(id), nmi, timestamp, SUM(consumption) FROM staging_meter_readings GROUP BY nmi, timestamp '
+    'ON DUPLICATE KEY UPDATE consumption = (meter_readings.consumption + VALUES(consumption))',
+    'DROP TEMPORARY TABLE staging_meter_readings',
+)
 
-def _is_decimal_value(s: str) -> bool:
-    parts = s.split('.')
-    return all(not part or part.isnumeric() for part in parts)
+
+# readings repeat a lot across a file, so converting each distinct one once turns most conversions into a lookup
+@lru_cache(maxsize=1 << 16)
+def _to_fixed_point(s: bytes) -> int | Decimal:
+    whole, _, frac = s.partition(b'.')
+    if len(frac) > CONSUMPTION_SCALE:
+        # NEM12 allows more decimals than the column keeps; keep them exact and leave the rounding to the DB
+        return Decimal(s.decode('ascii')).scaleb(CONSUMPTION_SCALE)
+    return int(whole or b'0') * 10 ** CONSUMPTION_SCALE + int(frac.ljust(CONSUMPTION_SCALE, b'0'))
+
+
+def _from_fixed_point(value: int | Decimal) -> Decimal:
+    return Decimal(value).scaleb(-CONSUMPTION_SCALE)
+
+
+@lru_cache(maxsize=8192)
+def _parse_date(s: bytes) -> datetime:
+    # NEM12 dates are YYYYMMDD in local (AEST) time, and only a handful of distinct days show up per file
+    return datetime(int(s[:4]), int(s[4:6]), int(s[6:8]), tzinfo=AUS_TZ)
+
+
+def _tsv_escape(s: str) -> str:
+    # LOAD DATA's default FIELDS ESCAPED BY '\\'
+    return s.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def _uuid7_hex_batch(n: int) -> list[str]:
+    """
+        Hex UUIDv7s for a batch of rows. The millisecond timestamp prefix keeps inserts clustered
+        at the end of the primary key index, and the random bits come from a single urandom call.
+    """
+    unix_ts_ms = time.time_ns() // 1_000_000
+    random_bytes = os.urandom(10 * n)
+    uuids = []
+    for idx in range(0, 10 * n, 10):
+        rand = int.from_bytes(random_bytes[idx:idx + 10])
+        # 48 bits of timestamp, version 7, 12 random bits, RFC 4122 variant, 62 random bits
+        uuid_int = unix_ts_ms << 80 | 0x7 << 76 | (rand >> 68) << 64 | 0b10 << 62 | rand & ((1 << 62) - 1)
+        uuids.append(f'{uuid_int:032x}')
+    return uuids
+
+
+def _sql_string_literal(s: str) -> str:
+    # same escaping the MySQL dialect applies when rendering literal binds
+    return "'" + s.replace('\\', '\\\\').replace("'", "''") + "'"
 
 
 class Base(DeclarativeBase):
@@ -50,10 +114,34 @@ class MeterReading(Base):
     id = Column(Uuid, primary_key=True, default=uuid.uuid4, nullable=False)
     nmi = Column(String(10), nullable=False)
     timestamp = Column(DateTime(timezone=True), nullable=False)
-    consumption = Column(Numeric(precision=6, scale=3), nullable=False)
+    consumption = Column(Numeric(precision=6, scale=CONSUMPTION_SCALE), nullable=False)
+
+
+def _compile_insert_stmt() -> tuple[str, str]:
+    """
+        Compiles the MySQL INSERT for meter readings once, with a single placeholder row,
+        and returns the SQL before and after that row's VALUES so batches can be spliced in between.
+        Duplicates of the (nmi, timestamp) key add up their consumption.
+    """
+    insert_stmt = insert(MeterReading).values([{
+        'id': uuid.UUID(int=0),
+        'nmi': '',
+        'timestamp': datetime(2000, 1, 1, tzinfo=AUS_TZ),
+        'consumption': Decimal(0)
+    }])
+    on_duplicate_key_stmt = insert_stmt.on_duplicate_key_update(
+        consumption=(MeterReading.consumption + insert_stmt.inserted.consumption)
+    )
+    compiled_statement = str(on_duplicate_key_stmt.compile(compile_kwargs={"literal_binds": True}))
+    values_start = compiled_statement.index(' VALUES ') + len(' VALUES ')
+    values_end = compiled_statement.index(' ON DUPLICATE KEY UPDATE ')
+    return compiled_statement[:values_start], compiled_statement[values_end:]
+
 
+INSERT_STMT_PREFIX, INSERT_STMT_SUFFIX = _compile_insert_stmt()
 
-def parse(filepath: str):
+
+def parse(filepath: str, workers: int = 1):
     """
         fp: File Pointer
         Algorithm:
@@ -62,76 +150,232 @@ def parse(filepath: str):
             - Generate the NMIs and consumptions
             - Aggregate the consumption values per NMI
         3. Generate SQL from the NMIs and consumptions
+        With more than one worker, step 2 is spread over processes by chunks of 200 blocks.
+    """
+    for meter_reading_batch in batched(read_meter_readings(filepath, workers), n=INSERT_BATCH_SIZE):
+        meter_reading_batch = _merge_duplicate_readings(meter_reading_batch)
+        ids = _uuid7_hex_batch(len(meter_reading_batch))
+        values = ', '.join([
+            f"('{id_}', {_sql_string_literal(mr['nmi'])}, '{mr['timestamp']}', {mr['consumption']})"
+            for id_, mr in zip(ids, meter_reading_batch)
+        ])
+        yield INSERT_STMT_PREFIX + values + INSERT_STMT_SUFFIX
+
+
+def parse_bulk_load(filepath: str, bulk_load_filepath: str, workers: int = 1):
+    """
+        Same parsing as parse, but the readings are written to a tab separated file at bulk_load_filepath
+        and the statements generated load that file in one go, instead of a stream of INSERTs.
+    """
+    with open(bulk_load_filepath, 'w', buffering=READ_BUFFER_SIZE) as bulk_load_file:
+        for meter_reading_batch in batched(read_meter_readings(filepath, workers), n=INSERT_BATCH_SIZE):
+            ids = _uuid7_hex_batch(len(meter_reading_batch))
+            bulk_load_file.writelines([
+                f"{id_}\t{_tsv_escape(mr['nmi'])}\t{mr['timestamp']}\t{mr['consumption']}\n"
+                for id_, mr in zip(ids, meter_reading_batch)
+            ])
+
+    load_stmt_path = _sql_string_literal(os.path.abspath(bulk_load_filepath))
+    for stmt in BULK_LOAD_STMTS:
+        yield stmt.format(load_stmt_path)
+
+
+def read_meter_readings(filepath: str, workers: int = 1) -> Iterable[dict]:
+    # NEM12 is plain ASCII, so the file is read as bytes and only the NMIs get decoded
+    with open(filepath, 'rb', buffering=READ_BUFFER_SIZE) as file:
+        header_row = next(file).rstrip(b'\r\n').split(b',')
+        assert header_row[0] == b'100', 'Header malformed or missing'
+        assert header_row[1] == b'NEM12', 'Only NEM12 format is supported'
+
+        if workers > 1:
+            yield from get_meter_readings_parallel(filepath, workers)
+        else:
+            yield from get_meter_readings(file)
+
+
+def _merge_duplicate_readings(meter_readings: Iterable[dict]) -> list[dict]:
+    # readings flushed at different times can share a key; summing them here means the
+    # INSERT touches each row once instead of going through ON DUPLICATE KEY UPDATE again
+    merged_readings = {}
+    for mr in meter_readings:
+        key = (mr['nmi'], mr['timestamp'])
+        if merged := merged_readings.get(key):
+            merged_readings[key] = {**merged, 'consumption': merged['consumption'] + mr['consumption']}
+        else:
+            merged_readings[key] = mr
+    return list(merged_readings.values())
+
+
+def get_meter_readings(file) -> Iterable[dict]:
+    yield from parse_records(file)
+
+
+def get_meter_readings_parallel(filepath: str, workers: int) -> Iterable[dict]:
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # keep a bounded number of chunks in flight so results don't pile up ahead of the consumer
+        pending_chunks = deque()
+        for start, end in _find_chunk_bounds(filepath, PARALLEL_CHUNK_SIZE):
+            pending_chunks.append(executor.submit(_aggregate_chunk, filepath, start, end))
+            if len(pending_chunks) > workers:
+                for consumption_records in pending_chunks.popleft().result():
+                    yield from _to_meter_readings(consumption_records)
+        while pending_chunks:
+            for consumption_records in pending_chunks.popleft().result():
+                yield from _to_meter_readings(consumption_records)
+
+
+def _find_chunk_bounds(filepath: str, chunk_size: int) -> list[tuple[int, int]]:
     """
-    with open(filepath, 'r') as file:
-        reader = csv.reader(file, delimiter=',')
-        header_row = next(reader)
-        assert header_row[0] == '100', 'Header malformed or missing'
-        assert header_row[1] == 'NEM12', 'Only NEM12 format is supported'
-
-        for meter_reading_batch in batched(get_meter_readings(reader), n=INSERT_BATCH_SIZE):
-            _insert_stmt = insert(MeterReading).values([{
-                'nmi': mr.nmi,
-                'timestamp': mr.timestamp,
-                'consumption': mr.consumption
-            } for mr in meter_reading_batch])
-
-            on_duplicate_key_stmt = _insert_stmt.on_duplicate_key_update(
-                consumption=(MeterReading.consumption + _insert_stmt.inserted.consumption)
-            )
-            compiled_statement = on_duplicate_key_stmt.compile(compile_kwargs={"literal_binds": True})
-            yield str(compiled_statement)
-
-
-def get_meter_readings(file_reader) -> Iterable[MeterReading]:
-    yield from parse_records(file_reader)
-
-
-def parse_records(file_reader) -> Iterable[MeterReading]:
-    consumption_records_agg = defaultdict(lambda: defaultdict(Decimal))
-    curr_nmi = ''
-    time_interval: int = 0
-    records_count = 0
-
-    for row in file_reader:
-        match row[0]:
-            case '200':
-                # 200 statement, we switch NMI context
-                curr_nmi = row[1]
-                time_interval = int(row[-2])
-            case '300':
-                assert curr_nmi, '300 record encountered before 200 record'
-                interval_date = datetime.strptime(row[1], '%Y%m%d').astimezone(AUS_TZ)
-                interval_count = row.index(next(elem for elem in row[2:] if not _is_decimal_value(elem))) - 2
-                for idx in range(interval_count):
-                    curr_timestamp = interval_date + timedelta(minutes=time_interval * idx)
-                    if reading := Decimal(row[idx+2]):
-                        if consumption_records_agg[curr_nmi][curr_timestamp] > 0:
-                            consumption_records_agg[curr_nmi][curr_timestamp] += Decimal(reading)
-                        else:
-                            records_count += 1
-                            consumption_records_agg[curr_nmi][curr_timestamp] = Decimal(reading)
-
-                        if records_count >= CONSUMPTION_MAPPING_SIZE_LIMIT:
-                            for nmi, timestamped_records in consumption_records_agg.items():
-                                for timestamp, consumption in timestamped_records.items():
-                                    yield MeterReading(nmi=nmi, timestamp=timestamp, consumption=consumption)
-                            consumption_records_agg.clear()
-                            records_count = 0
-            case '400':
-                # we don't need 400s yet
-                pass
-            case '500':
-                curr_nmi = ''
-                time_interval = 0
-                pass
-            case '900':
-                break
-
-    # clear the remaining for low mem mode (or the whole thing for the agg mode)
-    for nmi, timestamped_records in consumption_records_agg.items():
-        for timestamp, consumption in timestamped_records.items():
-            yield MeterReading(nmi=nmi, timestamp=timestamp, consumption=consumption)
+        Splits the file after the header into byte ranges of roughly chunk_size,
+        each starting on a 200 record so every chunk carries its own NMI context.
+    """
+    with open(filepath, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        chunk_bounds = []
+        start = mm.find(b'\n') + 1
+        while start < len(mm):
+            end = mm.find(b'\n200,', start + chunk_size)
+            end = len(mm) if end == -1 else end + 1
+            chunk_bounds.append((start, end))
+            start = end
+        return chunk_bounds
+
+
+def _aggregate_chunk(filepath: str, start: int, end: int) -> list[dict[tuple[str, int], int | Decimal]]:
+    with open(filepath, 'rb') as file:
+        file.seek(start)
+        chunk = io.BytesIO(file.read(end - start))
+    return list(aggregate_records(chunk))
+
+
+def _fold_readings(consumption_records_agg: dict[tuple[str, int], int | Decimal], nmi: str, day_start: int,
+                   interval_offsets: list[int], readings: list[bytes]) -> None:
+    """
+        Adds a day's non-zero readings for the NMI into the aggregation mapping.
+        Timestamps are POSIX seconds, which hash and compare much faster than tz-aware datetimes.
+    """
+    # bound to locals once so the loop below does fast local lookups instead of global/attribute ones
+    to_fixed_point = _to_fixed_point
+    get_consumption = consumption_records_agg.get
+    for offset, reading_str in zip(interval_offsets, readings):
+        # zero readings are dropped; the conversion is cached, so zeros cost a lookup
+        if reading := to_fixed_point(reading_str):
+            key = (nmi, day_start + offset)
+            if consumption := get_consumption(key):
+                consumption_records_agg[key] = consumption + reading
+            else:
+                consumption_records_agg[key] = reading
+
+
+def _to_meter_readings(consumption_records: dict[tuple[str, int], int | Decimal]) -> Iterable[dict]:
+    fromtimestamp = datetime.fromtimestamp
+    from_fixed_point = _from_fixed_point
+    for (nmi, timestamp), consumption in consumption_records.items():
+        yield {
+            'nmi': nmi,
+            'timestamp': fromtimestamp(timestamp, AUS_TZ),
+            'consumption': from_fixed_point(consumption)
+        }
+
+
+def parse_records(file) -> Iterable[dict]:
+    for consumption_records in aggregate_records(file):
+        yield from _to_meter_readings(consumption_records)
+
+
+@dataclass(slots=True)
+class _ParseState:
+    # aggregated consumption per day, least recently touched day first
+    pending_by_date: OrderedDict[int, dict[tuple[str, int], int | Decimal]] = field(default_factory=OrderedDict)
+    records_count: int = 0
+    curr_day_start: int | None = None
+    day_records: dict[tuple[str, int], int | Decimal] = field(default_factory=dict)
+    curr_nmi: str = ''
+    interval_offsets: list[int] = field(default_factory=list)
+    interval_count: int = 0
+    finished: bool = False
+
+
+def _handle_200(line: bytes, state: _ParseState) -> None:
+    # 200 statement, we switch NMI context
+    row = line.rstrip(b'\r\n').split(b',')
+    state.curr_nmi = row[1].decode('ascii')
+    time_interval = int(row[-2])
+    # NEM12 300 rows always hold a full day of readings for the interval length,
+    # which holds until the next 200, so the offsets into the day can be reused
+    state.interval_count = MINS_PER_DAY // time_interval
+    state.interval_offsets = [time_interval * 60 * idx for idx in range(state.interval_count)]
+
+
+def _handle_300(line: bytes, state: _ParseState) -> None:
+    assert state.curr_nmi, '300 record encountered before 200 record'
+    interval_count = state.interval_count
+    # stop splitting after the readings; the trailing flags and timestamps (and line ending)
+    # stay in the last field untouched
+    row = line.split(b',', 2 + interval_count)
+    # the readings are followed by the quality method flag, which is always a letter
+    assert len(row) > 2 + interval_count and row[2 + interval_count][:1].isalpha(), \
+        '300 record reading count does not match the 200 record interval length'
+    day_start = int(_parse_date(row[1]).timestamp())
+    if day_start != state.curr_day_start:
+        state.curr_day_start = day_start
+        state.day_records = state.pending_by_date.setdefault(day_start, {})
+        state.pending_by_date.move_to_end(day_start)
+
+    day_records = state.day_records
+    records_count = state.records_count - len(day_records)
+    _fold_readings(day_records, state.curr_nmi, day_start, state.interval_offsets, row[2:2 + interval_count])
+    state.records_count = records_count + len(day_records)
+
+
+def _handle_500(line: bytes, state: _ParseState) -> None:
+    state.curr_nmi = ''
+    state.interval_offsets = []
+    state.interval_count = 0
+
+
+def _handle_900(line: bytes, state: _ParseState) -> None:
+    state.finished = True
+
+
+def _ignore_record(line: bytes, state: _ParseState) -> None:
+    # the header is read before parsing starts, and we don't need 400s yet
+    pass
+
+
+# NEM12 record indicators all start with a different digit, so the first byte of a line is enough to dispatch on
+RECORD_HANDLERS = {
+    b'2': _handle_200,
+    b'3': _handle_300,
+    b'4': _ignore_record,
+    b'5': _handle_500,
+    b'9': _handle_900,
+}
+
+
+def aggregate_records(file) -> Iterable[dict[tuple[str, int], int | Decimal]]:
+    """
+        Yields the aggregated consumption per (nmi, timestamp), a day's worth at a time.
+    """
+    state = _ParseState()
+    get_handler = RECORD_HANDLERS.get
+
+    for line in file:
+        get_handler(line[:1], _ignore_record)(line, state)
+
+        # flush whole days, least recently touched first, so readings on the days
+        # still being filled in keep aggregating in memory
+        while state.records_count >= CONSUMPTION_MAPPING_SIZE_LIMIT:
+            oldest_day, oldest_records = state.pending_by_date.popitem(last=False)
+            state.records_count -= len(oldest_records)
+            yield oldest_records
+            if oldest_day == state.curr_day_start:
+                state.curr_day_start = None
+
+        if state.finished:
+            break
+
+    # clear the days still pending at the end of the file
+    yield from state.pending_by_date.values()
 
 
 if __name__ == '__main__':
@@ -141,11 +385,22 @@ if __name__ == '__main__':
     parser.add_argument('--output_file', nargs='?', type=str, default='',
                         help='Name of the file to write the insert statements to. '
                              'Ignore if you do not want the parser to write directly to a file.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to parse the file with. Worth raising for very large files.')
+    parser.add_argument('--bulk_load_file', nargs='?', type=str, default='',
+                        help='Name of a file to write the meter readings to as tab separated values. '
+                             'The statements generated will then bulk load this file instead of inserting row by row.')
     args = parser.parse_args()
+    if args.bulk_load_file:
+        stmts = parse_bulk_load(args.filepath, args.bulk_load_file, args.workers)
+    else:
+        stmts = parse(args.filepath, args.workers)
+    # terminate every statement so the output can be run as a script, e.g. piped into mysql;
+    # the bulk load statements also have to run in order in one session for the temporary table
     if args.output_file:
         with open(args.output_file, 'w') as output_file:
-            for insert_stmt in parse(args.filepath):
-                output_file.write(insert_stmt)
+            for insert_stmt in stmts:
+                output_file.write(insert_stmt + ';\n')
     else:
-        for r in parse(args.filepath):
-            print(r)
+        for r in stmts:
+            print(r + ';')
@@ -0,0 +1,117 @@
+import io
+import random
+import re
+import subprocess
+import sys
+from collections import defaultdict
+from decimal import Decimal
+
+import pytest
+
+import main_parser
+
+VALUES_ROW = re.compile(r"\('[0-9a-f]{32}', '([^']*)', '([^']*)', ([0-9.]+)\)")
+
+
+def _nem12_day(nmi: str, date: str, readings: list[str], interval: int = 30) -> bytes:
+    """A 200 block with a single 300 row, padding the readings with zeros up to a full day."""
+    readings = readings + ['0'] * (main_parser.MINS_PER_DAY // interval - len(readings))
+    return (f'200,{nmi},E1E2,1,E1,N1,01009,kWh,{interval},20050610\n'
+            f'300,{date},{",".join(readings)},A,,,20050310121004,20050310182204\n'
+            f'500,O,S01009,20050310121004,\n').encode('ascii')
+
+
+def _write_nem12(path, eol: str = '\n'):
+    """
+        A NEM12 file with a mix of interval lengths and decimals, where some NMIs come back
+        in later 200 blocks (another channel) for the same days.
+    """
+    rng = random.Random(12)
+    lines = ['100,NEM12,200506081149,UNITEDDP,NEMMCO']
+    blocks = [('NMI0', 30), ('NMI1', 5), ('NMI2', 15), ('NMI0', 5), ('NMI3', 30), ('NMI1', 30)]
+    # then single day blocks for the same date, so consecutive 300 rows share a day
+    blocks += [('NMI4', 30, 6), ('NMI5', 15, 6), ('NMI6', 30, 6)]
+    for nmi, interval, *days in blocks:
+        lines.append(f'200,{nmi},E1E2,1,E1,N1,01009,kWh,{interval},20050610')
+        for day in days or range(1, 7):
+            readings = [rng.choice(['0', '0.000', f'{rng.randint(1, 9999) / 1000}', f'{rng.random():.5f}'])
+                        for _ in range(main_parser.MINS_PER_DAY // interval)]
+            lines.append(f'300,200503{day:02},{",".join(readings)},A,,,20050310121004,20050310182204')
+            if day == 3:
+                lines.append('400,1,20,F14,76,')
+        lines.append('500,O,S01009,20050310121004,')
+    lines.append('900')
+    path.write_bytes(eol.join(lines + ['']).encode('ascii'))
+    return str(path)
+
+
+def _consumption_totals(stmts) -> dict[tuple[str, str], Decimal]:
+    """Sums the consumption per (nmi, timestamp) the way ON DUPLICATE KEY UPDATE would."""
+    totals = defaultdict(Decimal)
+    for stmt in stmts:
+        for nmi, timestamp, consumption in VALUES_ROW.findall(stmt):
+            totals[(nmi, timestamp)] += Decimal(consumption)
+    return dict(totals)
+
+
+def _consumptions(nem12_body: bytes) -> list[Decimal]:
+    return [mr['consumption'] for mr in main_parser.get_meter_readings(io.BytesIO(nem12_body))]
+
+
+def test_readings_keep_their_decimals():
+    assert _consumptions(_nem12_day('NMI1', '20050301', ['1.5', '0.461', '1.2346', '0.00051'])) == [
+        Decimal('1.500'), Decimal('0.461'), Decimal('1.2346'), Decimal('0.00051')
+    ]
+
+
+def test_readings_with_more_decimals_than_the_column_sum_exactly():
+    body = _nem12_day('NMI1', '20050301', ['1.2346', '0.0005', '0.1', '1.23']) * 2
+    assert _consumptions(body) == [Decimal('2.4692'), Decimal('0.0010'), Decimal('0.200'), Decimal('2.460')]
+
+
+def test_zero_readings_are_dropped():
+    body = _nem12_day('NMI1', '20050301', ['0', '0.0', '0.000', '000', '0.0004', '0.00000', '1'])
+    assert _consumptions(body) == [Decimal('0.0004'), Decimal('1.000')]
+
+
+def test_bulk_load_output_file_is_a_script(tmp_path):
+    nem12_path = tmp_path / 'nem12.csv'
+    nem12_path.write_bytes(b'100,NEM12,200506081149,UNITEDDP,NEMMCO\n'
+                           + _nem12_day('NMI1', '20050301', ['1.5', '0.25'])
+                           + b'900\n')
+    output_path = tmp_path / 'output.sql'
+    subprocess.run([sys.executable, main_parser.__file__, str(nem12_path),
+                    f'--output_file={output_path}', f'--bulk_load_file={tmp_path / "readings.tsv"}'], check=True)
+
+    stmts = output_path.read_text().splitlines()
+    assert [stmt.split(' ', 2)[:2] for stmt in stmts] == [
+        ['CREATE', 'TEMPORARY'], ['LOAD', 'DATA'], ['INSERT', 'INTO'], ['DROP', 'TEMPORARY']
+    ]
+    assert all(stmt.endswith(';') for stmt in stmts)
+
+
+@pytest.mark.parametrize('eol', ['\n', '\r\n'])
+def test_parallel_parse_matches_serial(tmp_path, monkeypatch, eol):
+    nem12_path = _write_nem12(tmp_path / 'nem12.csv', eol)
+    serial_totals = _consumption_totals(main_parser.parse(nem12_path))
+    assert len(serial_totals) > 1000
+
+    # chunks only split on 200 records, so this gives one chunk per 200 block
+    monkeypatch.setattr(main_parser, 'PARALLEL_CHUNK_SIZE', 1)
+    chunk_bounds = main_parser._find_chunk_bounds(nem12_path, main_parser.PARALLEL_CHUNK_SIZE)
+    assert len(chunk_bounds) == 9
+    with open(nem12_path, 'rb') as nem12_file:
+        nem12_bytes = nem12_file.read()
+    assert all(nem12_bytes[start:start + 4] == b'200,' for start, _ in chunk_bounds)
+
+    assert _consumption_totals(main_parser.parse(nem12_path, workers=3)) == serial_totals
+
+
+@pytest.mark.parametrize('size_limit', [1, 500])
+def test_day_flushes_keep_totals(tmp_path, monkeypatch, size_limit):
+    nem12_path = _write_nem12(tmp_path / 'nem12.csv')
+    unflushed_totals = _consumption_totals(main_parser.parse(nem12_path))
+
+    # a limit of 1 evicts the day currently being filled after every 300 row
+    monkeypatch.setattr(main_parser, 'CONSUMPTION_MAPPING_SIZE_LIMIT', size_limit)
+    assert _consumption_totals(main_parser.parse(nem12_path)) == unflushed_totals